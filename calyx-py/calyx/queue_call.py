@@ -2,6 +2,10 @@
 from calyx import queue_util
 import calyx.builder as cb
 
+# The width of an index into the command and answer lists of `main`.
+# It must be able to hold `MAX_CMDS` itself, which is where the loop stops.
+IDX_WIDTH = queue_util.MAX_CMDS.bit_length()
+
 
 def insert_main(prog, queue):
     """Inserts the component `main` into the program.
@@ -33,9 +37,18 @@ def insert_main(prog, queue):
     # - one ref register, `ans`, into which the result of a pop or peek is written.
     # - one ref register, `err`, which is raised if an error occurs.
 
-    commands = main.seq_mem_d1("commands", 2, queue_util.MAX_CMDS, 32, is_external=True)
-    values = main.seq_mem_d1("values", 32, queue_util.MAX_CMDS, 32, is_external=True)
-    ans_mem = main.seq_mem_d1("ans_mem", 32, queue_util.MAX_CMDS, 32, is_external=True)
+    commands = main.seq_mem_d1(
+        "commands", 2, queue_util.MAX_CMDS, IDX_WIDTH, is_external=True
+    )
+    values = main.seq_mem_d1(
+        "values", 32, queue_util.MAX_CMDS, IDX_WIDTH, is_external=True
+    )
+    # Answers are written one at a time, in order, at the index `j`.
+    # `seq_mem_d1` has no burst interface, so these writes cannot be coalesced
+    # here; that would fall to whatever wraps the external memory.
+    ans_mem = main.seq_mem_d1(
+        "ans_mem", 32, queue_util.MAX_CMDS, IDX_WIDTH, is_external=True
+    )
 
     # We'll invoke the queue component, which takes two inputs by reference
     # and one input directly.
@@ -47,8 +60,8 @@ def insert_main(prog, queue):
     # the commands to the `queue` component.
     # It will run until the `err` flag is raised by the `queue` component.
 
-    i = main.reg("i", 32)  # The index of the command we're currently processing
-    j = main.reg("j", 32)  # The index on the answer-list we'll write to
+    i = main.reg("i", IDX_WIDTH)  # The index of the command we're currently processing
+    j = main.reg("j", IDX_WIDTH)  # The index on the answer-list we'll write to
     cmd = main.reg("command", 2)  # The command we're currently processing
     value = main.reg("value", 32)  # The value we're currently processing
 
@@ -56,7 +69,9 @@ def insert_main(prog, queue):
     incr_j = main.incr(j)  # j++
     lower_err = main.reg_store(err, 0, "lower_err")  # err := 1
 
-    cmd_le_1 = main.le_use(cmd.out, 1)  # cmd <= 1
+    # cmd <= 1, meaning cmd is pop or peek. This is a combinational group on a
+    # 2-bit comparator, so the `if` that uses it costs no cycle of its own.
+    cmd_le_1 = main.le_use(cmd.out, 1)
 
     read_cmd = main.mem_read_seq_d1(commands, i.out, "read_cmd_phase1")
     write_cmd_to_reg = main.mem_write_seq_d1_to_reg(commands, cmd, "write_cmd_phase2")
@@ -73,10 +88,10 @@ def insert_main(prog, queue):
     main.control += cb.while_with(
         i_lt_max_cmds,  # Run while i < MAX_CMDS
         [
-            read_cmd,
-            write_cmd_to_reg,  # `cmd := commands[i]`
-            read_value,
-            write_value_to_reg,  # `value := values[i]`
+            cb.par(  # The two memories are independent, so read them together.
+                cb.seq(read_cmd, write_cmd_to_reg),  # `cmd := commands[i]`
+                cb.seq(read_value, write_value_to_reg),  # `value := values[i]`
+            ),
             cb.invoke(  # Invoke the queue.
                 queue,
                 in_cmd=cmd.out,
@@ -88,14 +103,18 @@ def insert_main(prog, queue):
                 not_err,
                 cb.if_with(
                     cmd_le_1,  # If the command was a pop or peek,
+                    # `write_ans` addresses `ans_mem` with `j.out`, so `j` may only
+                    # move once the write is done: these two cannot run in `par`.
                     [
                         write_ans,  # Write the answer to the answer list
                         incr_j,  # And increment the answer index.
                     ],
                 ),
             ),
-            lower_err,  # Lower the error flag
-            incr_i,  # Increment the command index
+            cb.par(
+                lower_err,  # Lower the error flag
+                incr_i,  # Increment the command index
+            ),
         ],
     )
 
@@ -184,10 +203,10 @@ def insert_runner(prog, queue, name, stats_component):
     )
 
     runner.control += [
-        read_cmd,
-        write_cmd_to_reg,  # `cmd := commands[i]`
-        read_value,
-        write_value_to_reg,  # `value := values[i]`
+        cb.par(  # The two memories are independent, so read them together.
+            cb.seq(read_cmd, write_cmd_to_reg),  # `cmd := commands[i]`
+            cb.seq(read_value, write_value_to_reg),  # `value := values[i]`
+        ),
         cb.invoke(  # Invoke the queue.
             queue,
             in_cmd=cmd.out,
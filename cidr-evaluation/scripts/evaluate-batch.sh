@@ -0,0 +1,38 @@
+#!/bin/bash
+
+set -o pipefail
+
+# Runs a batch of benchmark jobs from a single shell, sourcing each evaluation
+# script in a subshell instead of launching a new `bash` for every program.
+# Jobs are JSON objects, given either as a list in the file passed as the first
+# argument or as one object per line on stdin. The CSV rows go to each job's
+# `out` file, the scripts' own logging goes to stderr, and the exit status of
+# every job is reported on its own line of stdout. The batch exits with a
+# non-zero status if any of its jobs failed.
+# Example:
+#   JOBS='[{"script": "scripts/evaluate.sh",
+#           "program": "examples/futil/dot-product.futil",
+#           "data": "examples/dahlia/dot-product.fuse.data",
+#           "out": "dot-product.csv",
+#           "n": 10}]'
+JOBS=${1:-/dev/stdin}
+
+jq -r --unbuffered \
+    'if type == "array" then .[] else . end
+     | [.script, .program, .data, .out, (.n | tostring)]
+     | @tsv' \
+    "$JOBS" |
+{
+    FAILED=0
+    while IFS=$'\t' read -r script program data file intervals
+    do
+        ( set -- "$program" "$data" "$file" "$intervals"; source "$script" ) \
+            < /dev/null 1>&2
+        STATUS=$?
+        echo "$STATUS"
+        if (( STATUS != 0 )); then
+            FAILED=1
+        fi
+    done
+    exit $FAILED
+}
@@ -1,42 +1,79 @@
+import argparse
 import csv
+import json
+import os
+import re
+import shutil
 import subprocess
 import time
-import statistics as st
 from collections import defaultdict
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache
 import pathlib
 
+import numpy as np
+
 # Paths assumes you're running this script from the `futil` directory, i.e.
 #   python3 evaluations/cidr-pldi-2022/process-data.py
 
+# The number of cores a single benchmark job is expected to occupy. `fud`
+# pipelines may run the interpreter alongside other tools, so we avoid
+# scheduling one job per core to keep from oversubscribing the machine.
+THREADS_PER_JOB = 2
+
+# The number of benchmarks to run at once. Benchmarks running side by side
+# compete for cores, caches and memory, which skews the timings we collect and
+# multiplies peak memory usage, so they are run one at a time unless asked
+# otherwise with `--jobs`.
+DEFAULT_JOBS = 1
+
+# Runs every job it is sent from a single shell, see the script for details.
+BATCH_SCRIPT = "scripts/evaluate-batch.sh"
+
 
 def verify_interpreter_configuration():
     """
     Verifies the interpreter is in release mode and using
-    the --no-verify flag.
+    the --no-verify flag. Returns the path to the interpreter executable,
+    or `None` if it can't be found.
     """
 
-    def command_has_value(command, value, error):
+    # Both settings live under the same section, so fetch it once rather than
+    # paying for a `fud` startup per key. It is printed as TOML, e.g.
+    #   exec = "<PATH-TO-CALYX>/target/release/cider"
+    #   flags = " --no-verify "
+    # Any errors from `fud` go straight to the terminal, and a failing `fud`
+    # raises `subprocess.CalledProcessError` instead of an empty config.
+    config = subprocess.check_output(["fud", "config", "stages.interpreter"], text=True)
+
+    def config_has_value(key, value, error):
         """
-        Verifies that the stdout of this `command` has `value` in it.
+        Verifies that `key` in the interpreter configuration has `value` in it,
+        and returns the configured value.
         """
-        process = subprocess.run(command, capture_output=True)
-        assert value in str(process.stdout), error
+        match = re.search(rf'^{key} = "(.*)"$', config, re.MULTILINE)
+        assert match is not None and value in match.group(1), error
+        return match.group(1)
 
-    command_has_value(
-        ["fud", "config", "stages.interpreter.exec"],
+    executable = config_has_value(
+        "exec",
         "release",
         "The interpreter should be in release mode. "
         + "To fix this, run `fud config stages.interpreter.exec .<PATH-TO-CALYX>/target/release/cider`.",
     )
 
-    command_has_value(
-        ["fud", "config", "stages.interpreter.flags"],
+    config_has_value(
+        "flags",
         "--no-verify",
         "The interpreter should use the --no-verify flag. "
         + 'To fix this, run `fud config stages.interpreter.flags " --no-verify "`.',
     )
 
+    return shutil.which(executable)
+
 
+@lru_cache(maxsize=None)
 def get_csv_filename(name, lowered):
     """
     Uses the simulation name to produce the CSV file name, e.g. `Dot Product`
@@ -54,23 +91,141 @@ def get_csv_filename(name, lowered):
     )
 
 
-def process_data(dataset, is_fully_lowered, path, script, sim_num):
+class FudWorker:
     """
-    Runs the script for each iteration of dataset. `is_fully_lowered` is
-    just used to distinguish file names.
+    A long-lived `BATCH_SCRIPT` that runs benchmark jobs sent to it over
+    stdin. Fud has no server mode, so this keeps a single driver process
+    around per pool worker instead of launching a new one for every benchmark.
     """
-    for name, program in dataset:
-        subprocess.run(
-            [
-                script,
-                path + program,
-                # Assumes that the data is the same path with `.data` appended.
-                path + program + ".data",
-                get_csv_filename(name, is_fully_lowered),
-                str(sim_num),  # Number of simulations per program.
-            ]
+
+    def __init__(self):
+        self.process = subprocess.Popen(
+            [BATCH_SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
         )
 
+    def run(self, job):
+        """
+        Sends `job` to the driver and blocks until it completes.
+        Raises `subprocess.CalledProcessError` if the script fails.
+        """
+        self.process.stdin.write(json.dumps(job) + "\n")
+        self.process.stdin.flush()
+        status = self.process.stdout.readline()
+        if not status:
+            raise RuntimeError("The benchmark worker exited unexpectedly.")
+        if int(status) != 0:
+            raise subprocess.CalledProcessError(int(status), job)
+
+
+# The worker owned by the current pool process, see `start_worker`.
+worker = None
+
+
+def start_worker():
+    """Starts the `FudWorker` for this pool process."""
+    global worker
+    worker = FudWorker()
+
+
+def run_job(job):
+    """
+    Runs a single benchmark job, i.e. the script with its arguments, on
+    this process' worker.
+    """
+    worker.run(job)
+
+
+def is_up_to_date(job, interpreter):
+    """
+    Returns whether the CSV file of `job` is newer than its program, data,
+    script and the `interpreter` executable, and already holds at least `n`
+    timings for every stage it records. Such jobs don't need to be run again.
+    A CSV that can't be parsed, e.g. one cut short by an interrupted run, is
+    never up to date.
+    """
+    out = pathlib.Path(job["out"])
+    if interpreter is None or not out.is_file():
+        return False
+    modified = out.stat().st_mtime
+    sources = [job["program"], job["data"], job["script"], interpreter]
+    if any(modified < os.path.getmtime(source) for source in sources):
+        return False
+    try:
+        simtimes, comptimes = parse_csv(out)
+    except (AssertionError, ValueError):
+        return False
+    timings = [*simtimes.values(), *comptimes.values()]
+    return bool(timings) and all(len(times) >= job["n"] for times in timings)
+
+
+def process_data(
+    dataset, is_fully_lowered, path, script, sim_num, workers, interpreter, force
+):
+    """
+    Runs the script for each iteration of dataset. `is_fully_lowered` is
+    just used to distinguish file names. Each program is independent, so
+    the jobs are spread across a pool of `workers` processes; when `workers`
+    is 0, one is used per `THREADS_PER_JOB` cores. Unless `force` is set,
+    programs whose results are already up to date with respect to the
+    `interpreter` executable are skipped. The results of every program that
+    is run are discarded first, so they never mix with stale timings.
+    """
+    base = pathlib.Path(path)
+    jobs = [
+        {
+            "script": script,
+            "program": str(base / program),
+            # Assumes that the data is the same path with `.data` appended.
+            "data": str(base / f"{program}.data"),
+            "out": get_csv_filename(name, is_fully_lowered),
+            "n": sim_num,  # Number of simulations per program.
+        }
+        for name, program in dataset
+    ]
+    pending = []
+    for job in jobs:
+        if not force and is_up_to_date(job, interpreter):
+            print(f"[SKIPPED] {job['program']}: {job['out']} is up to date")
+        else:
+            pathlib.Path(job["out"]).unlink(missing_ok=True)
+            pending.append(job)
+    if not pending:
+        return
+
+    if workers == 0:
+        workers = max(1, (os.cpu_count() or 1) // THREADS_PER_JOB)
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(pending)), initializer=start_worker
+    ) as executor:
+        futures = {executor.submit(run_job, job): job for job in pending}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                future.result()
+            except subprocess.CalledProcessError as e:
+                print(f"[FAILED] {job['program']} exited with status {e.returncode}")
+
+
+def parse_csv(filename):
+    """
+    Returns two mappings from stage to a list of durations, for the simulation
+    and compilation steps recorded in `filename` respectively.
+    """
+    simtimes = defaultdict(list)
+    comptimes = defaultdict(list)
+    with open(filename, newline="") as file:
+        for row in csv.reader(file, delimiter=","):
+            # e.g. icarus-verilog.simulate,0.126
+            assert len(row) == 2, "expected CSV row: <stage-name>.<step>,<time>"
+            stage, _, step = row[0].partition(".")
+            # Anything that isn't a compilation step is a simulation step.
+            times = comptimes if "compile" in step else simtimes
+            times[stage].append(float(row[1]))
+    return simtimes, comptimes
+
 
 def gather_data(dataset, is_fully_lowered):
     """
@@ -79,52 +234,66 @@ def gather_data(dataset, is_fully_lowered):
     {
       "Dot Product" : {"verilog": [1.1, 2.1], "interpreter": [1.9, 2.2], ...}
     }
+    The CSV files are read concurrently, since this is bound by file I/O.
     """
+    names = [name for name, _ in dataset]
+    # Just use the simulation name, e.g. Dot Product -> Dot_Product.csv
+    filenames = [get_csv_filename(name, is_fully_lowered) for name in names]
     simulations = {}
     compilations = {}
-    for name, _ in dataset:
-        # Just use the simulation name, e.g. Dot Product -> Dot_Product.csv
-        with open(get_csv_filename(name, is_fully_lowered)) as file:
-            # Mapping from stage to a list of durations.
-            simtimes = defaultdict(list)
-            comptimes = defaultdict(list)
-            for row in csv.reader(file, delimiter=","):
-                # e.g. icarus-verilog,simulate,0.126
-                assert len(row) == 2, "expected CSV row: <stage-name>.<step>,<time>"
-                stage_step, time = row
-                stage, step = stage_step.split(".")
-                time = float(time)
-                if "compile" not in step:
-                    # This is a simulation step.
-                    simtimes[stage].append(time)
-                else:
-                    comptimes[stage].append(time)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for name, (simtimes, comptimes) in zip(
+            names, executor.map(parse_csv, filenames)
+        ):
             simulations[name] = simtimes
             compilations[name] = comptimes
 
     return simulations, compilations
 
 
-def write_csv_results(type, results):
+def summarize(times):
     """
-    Writes a CSV file with the format:
-    `type,stage,mean,median,stddev`
+    Returns the `(mean, median, stddev)` of `times`, each rounded to three
+    decimal places. The standard deviation is the sample standard deviation.
+    """
+    array = np.fromiter(times, dtype=np.float64, count=len(times))
+    mean = round(float(array.mean()), 3)
+    median = round(float(np.median(array)), 3)
+    stddev = round(float(array.std(ddof=1)), 3)
+    return mean, median, stddev
+
 
-    to `evaluations/cidr-pldi-2022/statistics/<type>-results.csv`.
+def open_writers(types, stack):
     """
-    path = pathlib.Path(f"statistics/{type}-results.csv")
-    preexisting = path.is_file()
+    Opens `evaluations/cidr-pldi-2022/statistics/<type>-results.csv` in append
+    mode for each of `types`, registering the files with the `ExitStack`
+    `stack`. Files that did not exist yet start with the header
+    `type,stage,mean,median,stddev`.
 
-    with open(path, "a", newline="") as file:
+    Returns a mapping from each type to the CSV writer for its file.
+    """
+    writers = {}
+    for type in types:
+        path = pathlib.Path(f"statistics/{type}-results.csv")
+        preexisting = path.is_file()
+        file = stack.enter_context(open(path, "a", newline="", buffering=1 << 20))
         writer = csv.writer(file, delimiter=",")
         if not preexisting:
             writer.writerow([type, "stage", "mean", "median", "stddev"])
-        for name, data in results.items():
-            for stage, times in data.items():
-                mean = round(st.mean(times), 3)
-                median = round(st.median(times), 3)
-                stddev = round(st.stdev(times), 3)
-                writer.writerow([name, stage, mean, median, stddev])
+        writers[type] = writer
+    return writers
+
+
+def write_csv_results(writer, results):
+    """
+    Writes a `name,stage,mean,median,stddev` row to `writer` for every stage
+    of every simulation in `results`.
+    """
+    writer.writerows(
+        [name, stage, *summarize(times)]
+        for name, data in results.items()
+        for stage, times in data.items()
+    )
 
 
 def write_to_file(data, filename):
@@ -142,16 +311,24 @@ def do_stats(data, is_fully_lowered: bool):
     simulations, compilations = gather_data(data, is_fully_lowered)
     # Provide meaning to the data.
     if is_fully_lowered:
-        write_csv_results("simulation-fully-lowered", simulations)
-    else:
         # No compilation for this, since we only run interpreter simulation for the fully-lowered script.
-        write_csv_results("compilation", compilations)
-        write_csv_results("simulation", simulations)
+        results = {"simulation-fully-lowered": simulations}
+    else:
+        results = {"compilation": compilations, "simulation": simulations}
+
+    with ExitStack() as stack:
+        writers = open_writers(results.keys(), stack)
+        for type, data in results.items():
+            write_csv_results(writers[type], data)
 
 
-def run(data, script, sim_num=10):
+def run(
+    data, script, sim_num=10, workers=DEFAULT_JOBS, interpreter=None, force=False
+):
     """
-    Runs the simulation and data processing on the datasets.
+    Runs the simulation and data processing on the datasets, with up to
+    `workers` benchmarks running at once. Results that are up to date with
+    respect to the `interpreter` executable are reused unless `force` is set.
     """
     # Run a different script for fully lowered Calyx. These are separated since Fud
     # has no way to dinstinguish profiling stage names based on previous stages.
@@ -164,6 +341,9 @@ def run(data, script, sim_num=10):
         path="benchmarks/",
         script=f"scripts/{script}",
         sim_num=sim_num,
+        workers=workers,
+        interpreter=interpreter,
+        force=force,
     )
 
     do_stats(data, is_fully_lowered)
@@ -171,15 +351,41 @@ def run(data, script, sim_num=10):
 
 def setup():
     """Creates the necessary directories to store statistics."""
-    subprocess.run(["mkdir", "-p", "individual-results"])
-    subprocess.run(["mkdir", "-p", "statistics"])
+    pathlib.Path("individual-results").mkdir(parents=True, exist_ok=True)
+    pathlib.Path("statistics").mkdir(parents=True, exist_ok=True)
 
 
 if __name__ == "__main__":
-    import sys
+    parser = argparse.ArgumentParser(description="Runs the Cider benchmarks.")
+    parser.add_argument(
+        "suite",
+        help="The benchmark set to run: 'core', 'lenet', 'core-no-ntt64' or 'full'.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=DEFAULT_JOBS,
+        help=(
+            "The number of benchmarks to run at once, or 0 to pick one per "
+            f"{THREADS_PER_JOB} cores. Running benchmarks concurrently affects "
+            "the measured timings and increases peak memory usage. "
+            f"Defaults to {DEFAULT_JOBS}."
+        ),
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Re-run every benchmark, even if its results are up to date.",
+    )
+    args = parser.parse_args()
+    if args.jobs < 0:
+        parser.error("--jobs must be at least 0")
 
     setup()
-    verify_interpreter_configuration()
+    interpreter = verify_interpreter_configuration()
+    options = {"workers": args.jobs, "interpreter": interpreter, "force": args.force}
 
     # A list of datasets to evaluate simulation performance, in the form:
     # (<table-name>, <program-path>). We just assume the data is at the same
@@ -288,57 +494,46 @@ if __name__ == "__main__":
         )
     ]
 
-    assert (
-        len(sys.argv) == 2
-    ), "Please provide exactly one benchmark set. Options are ('core', 'lenet', 'core-no-ntt64', 'full')"
-
-    if sys.argv[1].lower() == "core":
-
-        def program():
-            print("Running the core benchmark suite...")
-            # Run normal benchmarks on interpreter, Verilog, Icarus-Verilog.
-            run(datasets, "evaluate.sh")
-            # # Run benchmarks on fully lowered Calyx through the interpreter.
-            run(datasets, "evaluate-fully-lowered.sh")
-
-    elif sys.argv[1].lower() == "core-no-ntt64":
-        datasets.remove(
-            (
-                "NTT 64",
-                "ntt-64.futil",
-            )
+    def core():
+        print("Running the core benchmark suite...")
+        # Run normal benchmarks on interpreter, Verilog, Icarus-Verilog.
+        run(datasets, "evaluate.sh", **options)
+        # # Run benchmarks on fully lowered Calyx through the interpreter.
+        run(datasets, "evaluate-fully-lowered.sh", **options)
+
+    def core_no_ntt64():
+        print("Running the core benchmark suite without ntt-64...")
+        without_ntt64 = [d for d in datasets if d != ("NTT 64", "ntt-64.futil")]
+        # Run normal benchmarks on interpreter, Verilog, Icarus-Verilog.
+        run(without_ntt64, "evaluate.sh", **options)
+        # # Run benchmarks on fully lowered Calyx through the interpreter.
+        run(without_ntt64, "evaluate-fully-lowered.sh", **options)
+
+    def lenet_only():
+        print("Running lenet")
+        run(lenet, "evaluate.sh", sim_num=5, **options)
+
+    def full():
+        print("Running the full benchmark suite...")
+        # Run normal benchmarks on interpreter, Verilog, Icarus-Verilog.
+        run(datasets, "evaluate.sh", **options)
+        # Run benchmarks on fully lowered Calyx through the interpreter.
+        run(datasets, "evaluate-fully-lowered.sh", **options)
+
+        run(lenet, "evaluate.sh", sim_num=5, **options)
+
+    def invalid():
+        print(
+            "Not given a valid benchmark set, options are: ('core', 'lenet', 'core-no-ntt64', 'full')"
         )
 
-        def program():
-            print("Running the core benchmark suite without ntt-64...")
-            # Run normal benchmarks on interpreter, Verilog, Icarus-Verilog.
-            run(datasets, "evaluate.sh")
-            # # Run benchmarks on fully lowered Calyx through the interpreter.
-            run(datasets, "evaluate-fully-lowered.sh")
-
-    elif sys.argv[1].lower() == "lenet":
-
-        def program():
-            print("Running lenet")
-            run(lenet, "evaluate.sh", sim_num=5)
-
-    elif sys.argv[1].lower() == "full":
-
-        def program():
-            print("Running the full benchmark suite...")
-            # Run normal benchmarks on interpreter, Verilog, Icarus-Verilog.
-            run(datasets, "evaluate.sh")
-            # Run benchmarks on fully lowered Calyx through the interpreter.
-            run(datasets, "evaluate-fully-lowered.sh")
-
-            run(lenet, "evaluate.sh", sim_num=5)
-
-    else:
-
-        def program():
-            print(
-                "Not given a valid benchmark set, options are: ('core', 'lenet', 'core-no-ntt64', 'full')"
-            )
+    programs = {
+        "core": core,
+        "core-no-ntt64": core_no_ntt64,
+        "lenet": lenet_only,
+        "full": full,
+    }
+    program = programs.get(args.suite.casefold(), invalid)
 
     print("Beginning benchmarks...")
     begin = time.time()